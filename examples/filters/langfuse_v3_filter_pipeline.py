@@ -1,30 +1,91 @@
 """
 title: Langfuse Filter Pipeline for v3
 author: open-webui
-date: 2025-07-31
-version: 0.0.1
+date: 2026-10-15
+version: 0.0.2
 license: MIT
 description: A filter pipeline that uses Langfuse v3.
 requirements: langfuse>=3.0.0
 """
-from typing import List, Optional
+from typing import List, Literal, Optional
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import logging
 import os
 import uuid
 import json
-from utils.pipelines.main import get_last_assistant_message
-from pydantic import BaseModel
+import zlib
+from pydantic import BaseModel, Field
 from langfuse import Langfuse
 
+try:
+    # Optional: faster serialization for the input size check
+    import orjson
+except ImportError:
+    orjson = None
+
+# Queued events are sent to Langfuse in batches of up to MAX_BATCH_SIZE,
+# or whatever has arrived within BATCH_TIMEOUT seconds of the first one.
+MAX_BATCH_SIZE = 64
+BATCH_TIMEOUT = 0.2
+EVENT_QUEUE_SIZE = 10_000
+# Number of UUIDs generated per os.urandom call
+UUID_POOL_SIZE = 1024
+# Distinct messages remembered by log(suppress_repeats=True)
+SUPPRESSED_LOGS_SIZE = 1024
+# Tasks whose messages are the chat history; other tasks (title, tags, ...)
+# send their own prompt
+CHAT_TASKS = ("user_response", "llm_response")
+
+
+def _dumps(obj) -> bytes:
+    """Serialize obj to JSON bytes, with orjson when it is installed."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            # e.g. integers wider than 64 bits, which stdlib json handles
+            pass
+    return json.dumps(obj, default=str).encode()
+
 
 def get_last_assistant_message_obj(messages: List[dict]) -> dict:
     """Retrieve the last assistant message from the message list."""
-    for message in reversed(messages):
-        if message["role"] == "assistant":
-            return message
-    return {}
+    return next((m for m in reversed(messages) if m["role"] == "assistant"), {})
 
 
 class Pipeline:
+    # No per-instance __dict__: these attributes are read on every request
+    __slots__ = (
+        "type",
+        "name",
+        "valves",
+        "langfuse",
+        "chat_traces",
+        "suppressed_logs",
+        "model_names",
+        "_logger",
+        "_input_logged",
+        "_last_sent_len",
+        "_executor",
+        "_event_q",
+        "_batch_task",
+        "_flush_task",
+        "_tag_cache",
+        "_uuid_pool",
+        "_insert_tags",
+        "_use_name",
+        "_flush_interval",
+        "_sampling_rate",
+        "_sampling_key",
+        "_max_input_bytes",
+        "_max_chats",
+        "_pipelines_set",
+        "_pipelines_wildcard",
+    )
+
     class Valves(BaseModel):
         pipelines: List[str] = []
         priority: int = 0
@@ -36,6 +97,15 @@ class Pipeline:
         # New valve that controls whether to use model name instead of model ID for generation
         use_model_name_instead_of_id_for_generation: bool = False
         debug: bool = False
+        # Per-chat state is kept for at most this many chats (least recently used are evicted)
+        max_chats: int = Field(default=10_000, ge=1)
+        # Buffered Langfuse data is flushed in the background this often
+        flush_interval_seconds: int = Field(default=30, gt=0)
+        # Fraction of chats to trace; the decision is stable per sampling_key ("chat_id" or "user_id")
+        sampling_rate: float = Field(default=1.0, ge=0.0, le=1.0)
+        sampling_key: Literal["chat_id", "user_id"] = "chat_id"
+        # Inputs serializing to more than this many bytes are cut down to the last message
+        max_input_bytes: int = Field(default=1_000_000, gt=0)
 
     def __init__(self):
         self.type = "filter"
@@ -50,53 +120,218 @@ class Pipeline:
                 "debug": os.getenv("DEBUG_MODE", "false").lower() == "true",
             }
         )
+        self._logger = logging.getLogger("langfuse_pipeline")
         self.langfuse = None
-        self.chat_traces = {}
-        self.suppressed_logs = set()
+        self.chat_traces = OrderedDict()
+        self.suppressed_logs = OrderedDict()
         # Dictionary to store model names for each chat
-        self.model_names = {}
+        self.model_names = OrderedDict()
+        # (message count, CRC32 of last message content) of the last user turn logged for each chat
+        self._input_logged = OrderedDict()
+        # Number of messages already sent as generation input for each chat
+        self._last_sent_len = OrderedDict()
+        # Langfuse SDK calls run here so they never block the event loop
+        self._executor = ThreadPoolExecutor(max_workers=2)
+        # inlet/outlet only enqueue events; _drain_loop sends them in batches
+        self._event_q: Optional[asyncio.Queue] = None
+        self._batch_task: Optional[asyncio.Task] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        # Tags per (insert_tags, task_name), reset when valves change
+        self._tag_cache = {}
+        # Pre-generated UUID strings for event names and ids
+        self._uuid_pool = deque()
+        self._apply_valves()
+
+    def log(self, message: str, *args, suppress_repeats: bool = False):
+        """Debug log with %-style args, only formatted when debug is enabled."""
+        if not self._logger.isEnabledFor(logging.DEBUG):
+            return
+        if suppress_repeats:
+            # Key on the formatted text so different args are not suppressed
+            formatted = message % args if args else message
+            if formatted in self.suppressed_logs:
+                self.suppressed_logs.move_to_end(formatted)
+                return
+            self.suppressed_logs[formatted] = None
+            if len(self.suppressed_logs) > SUPPRESSED_LOGS_SIZE:
+                self.suppressed_logs.popitem(last=False)
+        self._logger.debug(message, *args)
+
+    def _lru_set(self, od: OrderedDict, key, value) -> list:
+        """Insert into a per-chat OrderedDict, returning the (key, value) pairs evicted."""
+        od[key] = value
+        od.move_to_end(key)
+        evicted = []
+        while len(od) > self._max_chats:
+            evicted.append(od.popitem(last=False))
+        return evicted
+
+    def _refill_uuids(self, n: int = UUID_POOL_SIZE):
+        """Generate n UUID4 strings from a single os.urandom call."""
+        raw = os.urandom(16 * n)
+        self._uuid_pool.extend(
+            str(uuid.UUID(bytes=raw[i : i + 16], version=4))
+            for i in range(0, 16 * n, 16)
+        )
+
+    def _next_uuid(self) -> str:
+        try:
+            return self._uuid_pool.popleft()
+        except IndexError:
+            self._refill_uuids()
+            return self._uuid_pool.popleft()
+
+    def _run_in_executor(self, fn, *args, **kwargs) -> asyncio.Future:
+        """Run a blocking Langfuse SDK call on the worker pool."""
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs)
+        )
+
+    def _enqueue(self, event: dict):
+        """Buffer an event for the background batch task."""
+        if self._event_q is None:
+            self.log("[WARNING] Langfuse event queue not started - Skipped")
+            return
+        try:
+            self._event_q.put_nowait(event)
+        except asyncio.QueueFull:
+            self.log(
+                "[WARNING] Langfuse event queue full, dropping %s event for chat_id: %s",
+                event["kind"],
+                event["chat_id"],
+            )
+
+    async def _drain_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = []
+            try:
+                batch.append(await self._event_q.get())
+                deadline = loop.time() + BATCH_TIMEOUT
+                while len(batch) < MAX_BATCH_SIZE:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(
+                            await asyncio.wait_for(self._event_q.get(), timeout)
+                        )
+                    except asyncio.TimeoutError:
+                        break
+            except asyncio.CancelledError:
+                # Shutting down: send the partial batch before the rest of the queue
+                if batch:
+                    self._emit_batch(batch)
+                raise
+            try:
+                await self._run_in_executor(self._emit_batch, batch)
+            except Exception as e:
+                self.log("Failed to send Langfuse batch: %s", e)
 
-    def log(self, message: str, suppress_repeats: bool = False):
-        if self.valves.debug:
-            if suppress_repeats:
-                if message in self.suppressed_logs:
-                    return
-                self.suppressed_logs.add(message)
-            print(f"[DEBUG] {message}")
+    async def _periodic_flush(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            if not self.langfuse:
+                continue
+            try:
+                await self._run_in_executor(self.langfuse.flush)
+                self.log("Langfuse data flushed")
+            except Exception as e:
+                self.log("Failed to flush Langfuse data: %s", e)
 
     async def on_startup(self):
-        self.log(f"on_startup triggered for {__name__}")
+        # main.py replaces self.valves with the saved valves.json before
+        # startup without calling on_valves_updated, so refresh the copies here
+        self._apply_valves()
+        self.log("on_startup triggered for %s", __name__)
         self.set_langfuse()
+        self._event_q = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self._batch_task = asyncio.create_task(self._drain_loop())
+        self._flush_task = asyncio.create_task(self._periodic_flush())
 
     async def on_shutdown(self):
-        self.log(f"on_shutdown triggered for {__name__}")
+        self.log("on_shutdown triggered for %s", __name__)
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+        if self._batch_task:
+            self._batch_task.cancel()
+            try:
+                await self._batch_task
+            except asyncio.CancelledError:
+                pass
+            self._batch_task = None
+        # Let in-flight SDK calls finish before ending traces and flushing
+        self._executor.shutdown(wait=True)
         if self.langfuse:
+            # Send whatever the batch task had not picked up yet
+            pending = []
+            while self._event_q and not self._event_q.empty():
+                pending.append(self._event_q.get_nowait())
+            if pending:
+                self._emit_batch(pending)
             try:
                 # End all active traces
                 for chat_id, trace in self.chat_traces.items():
                     try:
                         trace.end()
-                        self.log(f"Ended trace for chat_id: {chat_id}")
+                        self.log("Ended trace for chat_id: %s", chat_id)
                     except Exception as e:
-                        self.log(f"Failed to end trace for {chat_id}: {e}")
+                        self.log("Failed to end trace for %s: %s", chat_id, e)
                 self.chat_traces.clear()
                 self.langfuse.flush()
                 self.log("Langfuse data flushed on shutdown")
             except Exception as e:
-                self.log(f"Failed to flush Langfuse data: {e}")
+                self.log("Failed to flush Langfuse data: %s", e)
 
     async def on_valves_updated(self):
         self.log("Valves updated, resetting Langfuse client.")
+        self._apply_valves()
         self.set_langfuse()
 
+    def _apply_valves(self):
+        """
+        Precompute the valve-derived state read on every request, so the hot
+        path uses plain attributes instead of pydantic field access.
+        """
+        self._tag_cache.clear()
+        self._insert_tags = self.valves.insert_tags
+        self._use_name = self.valves.use_model_name_instead_of_id_for_generation
+        self._flush_interval = self.valves.flush_interval_seconds
+        self._sampling_rate = self.valves.sampling_rate
+        self._sampling_key = self.valves.sampling_key
+        self._max_input_bytes = self.valves.max_input_bytes
+        self._max_chats = self.valves.max_chats
+        self._pipelines_set = frozenset(self.valves.pipelines)
+        self._pipelines_wildcard = "*" in self._pipelines_set
+        self._logger.setLevel(logging.DEBUG if self.valves.debug else logging.INFO)
+
+    def _is_traced(self, body: dict) -> bool:
+        return self._pipelines_wildcard or body.get("model") in self._pipelines_set
+
+    def _is_sampled(self, chat_id: str, user: Optional[dict]) -> bool:
+        """
+        Head-based sampling keyed on a CRC32 hash, so a whole conversation
+        (or every conversation of a user) is either fully traced or dropped.
+        """
+        if self._sampling_rate >= 1.0:
+            return True
+        key = chat_id
+        if self._sampling_key == "user_id" and user:
+            key = user.get("email") or chat_id
+        return zlib.crc32(str(key).encode()) / 2**32 < self._sampling_rate
+
     def set_langfuse(self):
         try:
-            self.log(f"Initializing Langfuse with host: {self.valves.host}")
+            self.log("Initializing Langfuse with host: %s", self.valves.host)
             self.log(
-                f"Secret key set: {'Yes' if self.valves.secret_key and self.valves.secret_key != 'your-secret-key-here' else 'No'}"
+                "Secret key set: %s",
+                "Yes" if self.valves.secret_key and self.valves.secret_key != "your-secret-key-here" else "No",
             )
             self.log(
-                f"Public key set: {'Yes' if self.valves.public_key and self.valves.public_key != 'your-public-key-here' else 'No'}"
+                "Public key set: %s",
+                "Yes" if self.valves.public_key and self.valves.public_key != "your-public-key-here" else "No",
             )
             # Initialize Langfuse client for v3.2.1
             self.langfuse = Langfuse(
@@ -109,10 +344,12 @@ class Pipeline:
             try:
                 self.langfuse.auth_check()
                 self.log(
-                    f"Langfuse client initialized and authenticated successfully. Connected to host: {self.valves.host}")
+                    "Langfuse client initialized and authenticated successfully. Connected to host: %s",
+                    self.valves.host,
+                )
             except Exception as e:
-                self.log(f"Auth check failed: {e}")
-                self.log(f"Failed host: {self.valves.host}")
+                self.log("Auth check failed: %s", e)
+                self.log("Failed host: %s", self.valves.host)
                 self.langfuse = None
                 return
         except Exception as auth_error:
@@ -121,55 +358,73 @@ class Pipeline:
                 or "unauthorized" in str(auth_error).lower()
                 or "credentials" in str(auth_error).lower()
             ):
-                self.log(f"Langfuse credentials incorrect: {auth_error}")
+                self.log("Langfuse credentials incorrect: %s", auth_error)
                 self.langfuse = None
                 return
         except Exception as e:
-            self.log(f"Langfuse initialization error: {e}")
+            self.log("Langfuse initialization error: %s", e)
             self.langfuse = None
 
-    def _build_tags(self, task_name: str) -> list:
+    def _build_tags(self, task_name: str) -> tuple:
         """
-        Builds a list of tags based on valve settings, ensuring we always add
+        Builds the tags based on valve settings, ensuring we always add
         'open-webui' and skip user_response / llm_response from becoming tags themselves.
+        Results are cached per (insert_tags, task_name) since the set of task names is small.
         """
-        tags_list = []
-        if self.valves.insert_tags:
-            # Always add 'open-webui'
-            tags_list.append("open-webui")
-            # Add the task_name if it's not one of the excluded defaults
-            if task_name not in ["user_response", "llm_response"]:
-                tags_list.append(task_name)
-        return tags_list
+        key = (self._insert_tags, task_name)
+        tags = self._tag_cache.get(key)
+        if tags is None:
+            tags_list = []
+            if self._insert_tags:
+                # Always add 'open-webui'
+                tags_list.append("open-webui")
+                # Add the task_name if it's not one of the excluded defaults
+                if task_name not in ["user_response", "llm_response"]:
+                    tags_list.append(task_name)
+            tags = self._tag_cache[key] = tuple(tags_list)
+        return tags
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
+        if not self._is_traced(body):
+            return body
         self.log("Langfuse Filter INLET called")
         # Check Langfuse client status
         if not self.langfuse:
             self.log("[WARNING] Langfuse client not initialized - Skipped")
             return body
-        self.log(f"Inlet function called with body: {body} and user: {user}")
+        self.log("Inlet function called with body: %s and user: %s", body, user)
         metadata = body.get("metadata", {})
-        chat_id = metadata.get("chat_id", str(uuid.uuid4()))
+        chat_id = metadata["chat_id"] if "chat_id" in metadata else self._next_uuid()
         # Handle temporary chats
         if chat_id == "local":
             session_id = metadata.get("session_id")
             chat_id = f"temporary-session-{session_id}"
         metadata["chat_id"] = chat_id
         body["metadata"] = metadata
+        if not self._is_sampled(chat_id, user):
+            self.log("Chat not sampled, skipping trace for chat_id: %s", chat_id)
+            return body
         # Extract and store both model name and ID if available
         model_info = metadata.get("model", {})
         model_id = body.get("model")
        
         # Store model information for this chat
-        if chat_id not in self.model_names:
-            self.model_names[chat_id] = {"id": model_id}
+        model_entry = self.model_names.get(chat_id)
+        if model_entry is None:
+            model_entry = {}
+            self._lru_set(self.model_names, chat_id, model_entry)
         else:
-            self.model_names[chat_id]["id"] = model_id
+            self.model_names.move_to_end(chat_id)
+        model_entry["id"] = model_id
            
         if isinstance(model_info, dict) and "name" in model_info:
-            self.model_names[chat_id]["name"] = model_info["name"]
-            self.log(f"Stored model info - name: '{model_info['name']}', id: '{model_id}' for chat_id: {chat_id}")
+            model_entry["name"] = model_info["name"]
+            self.log(
+                "Stored model info - name: '%s', id: '%s' for chat_id: %s",
+                model_info["name"],
+                model_id,
+                chat_id,
+            )
         required_keys = ["model", "messages"]
         missing_keys = [key for key in required_keys if key not in body]
         if missing_keys:
@@ -181,117 +436,109 @@ class Pipeline:
         task_name = metadata.get("task", "user_response")
         # Build tags
         tags_list = self._build_tags(task_name)
-        if chat_id not in self.chat_traces:
-            self.log(f"Creating new trace for chat_id: {chat_id}")
-            try:
-                # Create trace using Langfuse v3 API with complete data
-                trace_metadata = {
-                    **metadata,
-                    "user_id": user_email,
-                    "session_id": chat_id,
-                    "interface": "open-webui",
-                }
-               
-                # Create trace with all necessary information
-                trace = self.langfuse.start_span(
-                    name=f"chat:{chat_id}",
-                    input=body,
-                    metadata=trace_metadata
-                )
-                # Set additional trace attributes
-                trace.update_trace(
-                    user_id=user_email,
-                    session_id=chat_id,
-                    tags=tags_list if tags_list else None,
-                    input=body,
-                    metadata=trace_metadata,
-                )
-                self.chat_traces[chat_id] = trace
-                self.log(f"Successfully created trace for chat_id: {chat_id}")
-            except Exception as e:
-                self.log(f"Failed to create trace: {e}")
-                return body
-        else:
-            trace = self.chat_traces[chat_id]
-            self.log(f"Reusing existing trace for chat_id: {chat_id}")
-            # Update trace with current metadata and tags
-            trace_metadata = {
-                **metadata,
-                "user_id": user_email,
-                "session_id": chat_id,
-                "interface": "open-webui",
-            }
-            trace.update_trace(
-                tags=tags_list if tags_list else None,
-                metadata=trace_metadata,
-            )
+        # The worker serializes the trace input later, so snapshot the body
+        # before metadata is tagged below
+        trace_input = {**body, "metadata": dict(metadata)}
+        trace_metadata = {
+            **metadata,
+            "user_id": user_email,
+            "session_id": chat_id,
+            "interface": "open-webui",
+        }
         # Update metadata with type
         metadata["type"] = task_name
         metadata["interface"] = "open-webui"
-        # Log user input as event
-        try:
-            trace = self.chat_traces[chat_id]
-           
-            # Create complete event metadata
+        # Regenerating a response re-sends the same user turn, so its input
+        # is only logged once; an edited turn has different content and is
+        # logged again even if the message count is unchanged
+        span_payload = None
+        messages = body["messages"]
+        # Fixed-size fingerprint, so large (e.g. image) content is not kept around
+        last_turn = (
+            len(messages),
+            zlib.crc32(_dumps(messages[-1].get("content"))) if messages else None,
+        )
+        is_user_turn = task_name == "user_response"
+        if not is_user_turn or self._input_logged.get(chat_id) != last_turn:
+            # Create complete event metadata from the trace metadata built above
             event_metadata = {
-                **metadata,
+                **trace_metadata,
                 "type": "user_input",
-                "interface": "open-webui",
-                "user_id": user_email,
-                "session_id": chat_id,
-                "event_id": str(uuid.uuid4()),
+                "event_id": self._next_uuid(),
             }
-           
-            event_span = trace.start_span(
-                name=f"user_input:{str(uuid.uuid4())}",
-                metadata=event_metadata,
-                input=body["messages"],
-            )
-            event_span.end()
-            self.log(f"User input event logged for chat_id: {chat_id}")
-        except Exception as e:
-            self.log(f"Failed to log user input event: {e}")
+            span_payload = {
+                "name": f"user_input:{self._next_uuid()}",
+                "metadata": event_metadata,
+                "input": self._new_messages(chat_id, messages, task_name),
+            }
+        if is_user_turn:
+            self._lru_set(self._input_logged, chat_id, last_turn)
+        # Log user input as event
+        self._enqueue(
+            {
+                "kind": "input",
+                "chat_id": chat_id,
+                "trace_input": trace_input,
+                "trace_update": {
+                    "user_id": user_email,
+                    "session_id": chat_id,
+                    "tags": list(tags_list) if tags_list else None,
+                    "metadata": trace_metadata,
+                },
+                "span_payload": span_payload,
+            }
+        )
         return body
 
     async def outlet(self, body: dict, user: Optional[dict] = None) -> dict:
+        if not self._is_traced(body):
+            return body
         self.log("Langfuse Filter OUTLET called")
         # Check Langfuse client status
         if not self.langfuse:
             self.log("[WARNING] Langfuse client not initialized - Skipped")
             return body
-        self.log(f"Outlet function called with body: {body}")
+        self.log("Outlet function called with body: %s", body)
         chat_id = body.get("chat_id")
         # Handle temporary chats
         if chat_id == "local":
             session_id = body.get("session_id")
             chat_id = f"temporary-session-{session_id}"
+        if not self._is_sampled(chat_id, user):
+            return body
         metadata = body.get("metadata", {})
         # Defaulting to 'llm_response' if no task is provided
         task_name = metadata.get("task", "llm_response")
         # Build tags
         tags_list = self._build_tags(task_name)
-        if chat_id not in self.chat_traces:
-            self.log(f"[WARNING] No matching trace found for chat_id: {chat_id}, attempting to re-register.")
-            # Re-run inlet to register if somehow missing
-            return await self.inlet(body, user)
-        self.chat_traces[chat_id]
-        assistant_message = get_last_assistant_message(body["messages"])
         assistant_message_obj = get_last_assistant_message_obj(body["messages"])
+        if not assistant_message_obj:
+            self.log("No assistant message, skipping outlet Langfuse calls for chat_id: %s", chat_id)
+            return body
+        # The worker serializes the trace input later, so snapshot the body
+        # before metadata is tagged below
+        trace_input = (
+            {**body, "metadata": dict(metadata)} if "metadata" in body else body
+        )
+        # Same result as get_last_assistant_message, without scanning the messages again
+        assistant_message = assistant_message_obj.get("content")
+        if isinstance(assistant_message, list):
+            assistant_message = next(
+                (item["text"] for item in assistant_message if item["type"] == "text"),
+                assistant_message,
+            )
         usage = None
-        if assistant_message_obj:
-            info = assistant_message_obj.get("usage", {})
-            if isinstance(info, dict):
-                input_tokens = info.get("prompt_eval_count") or info.get("prompt_tokens")
-                output_tokens = info.get("eval_count") or info.get("completion_tokens")
-                if input_tokens is not None and output_tokens is not None:
-                    usage = {
-                        "input": input_tokens,
-                        "output": output_tokens,
-                        "unit": "TOKENS",
-                    }
-                    self.log(f"Usage data extracted: {usage}")
-        # Update the trace with complete output information
-        trace = self.chat_traces[chat_id]
+        info = assistant_message_obj.get("usage", {})
+        if isinstance(info, dict):
+            input_tokens = info.get("prompt_eval_count") or info.get("prompt_tokens")
+            output_tokens = info.get("eval_count") or info.get("completion_tokens")
+            if input_tokens is not None and output_tokens is not None:
+                usage = {
+                    "input": input_tokens,
+                    "output": output_tokens,
+                    "unit": "TOKENS",
+                }
+                self.log("Usage data extracted: %s", usage)
        
         metadata["type"] = task_name
         metadata["interface"] = "open-webui"
@@ -304,63 +551,153 @@ class Pipeline:
             "interface": "open-webui",
             "task": task_name,
         }
-       
-        # Update trace with output and complete metadata
-        trace.update_trace(
-            output=assistant_message,
-            metadata=complete_trace_metadata,
-            tags=tags_list if tags_list else None,
-        )
         # Outlet: Always create LLM generation (this is the LLM response)
         # Determine which model value to use based on the use_model_name valve
-        model_id = self.model_names.get(chat_id, {}).get("id", body.get("model"))
-        model_name = self.model_names.get(chat_id, {}).get("name", "unknown")
+        model_entry = self.model_names.get(chat_id) or {}
+        model_id = model_entry.get("id", body.get("model"))
+        model_name = model_entry.get("name", "unknown")
         # Pick primary model identifier based on valve setting
         model_value = (
             model_name
-            if self.valves.use_model_name_instead_of_id_for_generation
+            if self._use_name
             else model_id
         )
         # Add both values to metadata regardless of valve setting
         metadata["model_id"] = model_id
         metadata["model_name"] = model_name
-        # Create LLM generation for the response
-        try:
-            trace = self.chat_traces[chat_id]
-           
-            # Create complete generation metadata
-            generation_metadata = {
-                **complete_trace_metadata,
-                "type": "llm_response",
-                "model_id": model_id,
-                "model_name": model_name,
-                "generation_id": str(uuid.uuid4()),
+        # Create complete generation metadata from the trace metadata built above
+        generation_metadata = {
+            **complete_trace_metadata,
+            "type": "llm_response",
+            "model_id": model_id,
+            "model_name": model_name,
+            "generation_id": self._next_uuid(),
+        }
+        messages = body["messages"]
+        generation_input = self._new_messages(chat_id, messages, task_name)
+        if task_name in CHAT_TASKS:
+            self._lru_set(self._last_sent_len, chat_id, len(messages))
+        # A trace that was never registered by inlet is created on demand
+        # when the batch task picks this event up
+        self._enqueue(
+            {
+                "kind": "response",
+                "chat_id": chat_id,
+                "trace_input": trace_input,
+                "trace_update": {
+                    "output": assistant_message,
+                    "metadata": complete_trace_metadata,
+                    "tags": list(tags_list) if tags_list else None,
+                },
+                "generation_payload": {
+                    "name": f"llm_response:{self._next_uuid()}",
+                    "model": model_value,
+                    "input": generation_input,
+                    "output": assistant_message,
+                    "metadata": generation_metadata,
+                },
+                "usage": usage,
             }
-           
-            generation = trace.start_generation(
-                name=f"llm_response:{str(uuid.uuid4())}",
-                model=model_value,
-                input=body["messages"],
-                output=assistant_message,
-                metadata=generation_metadata,
+        )
+        return body
+
+    def _emit_batch(self, batch: List[dict]):
+        """Send queued events to Langfuse, grouped by chat. Runs on the worker pool."""
+        if not self.langfuse:
+            self.log("[WARNING] Langfuse client not initialized - dropping batch")
+            return
+        chats = {}
+        for event in batch:
+            chats.setdefault(event["chat_id"], []).append(event)
+        for chat_id, events in chats.items():
+            try:
+                self._emit_chat_events(chat_id, events)
+            except Exception as e:
+                self.log("Failed to send Langfuse events for chat_id: %s: %s", chat_id, e)
+
+    def _new_messages(
+        self, chat_id: str, messages: List[dict], task_name: str
+    ) -> List[dict]:
+        """
+        Only the messages added since the last response was sent; a history
+        that did not grow (regenerate, edit) or a task prompt is returned in full.
+        """
+        if task_name not in CHAT_TASKS:
+            return messages
+        sent = self._last_sent_len.get(chat_id, 0)
+        return messages[sent:] if sent < len(messages) else messages
+
+    def _cap_input(self, payload, messages: List[dict]):
+        """
+        Returns payload unchanged, or only the last message if payload
+        serializes to more than max_input_bytes. Runs on the worker pool.
+        """
+        if len(_dumps(payload)) <= self._max_input_bytes:
+            return payload
+        return {"messages": messages[-1:], "_truncated": True}
+
+    def _emit_chat_events(self, chat_id: str, events: List[dict]):
+        """
+        Replays one chat's events in order, folding all trace updates into a
+        single update_trace call per response (or per batch, if none).
+        """
+        trace = self.chat_traces.get(chat_id)
+        if trace is not None:
+            self.chat_traces.move_to_end(chat_id)
+        trace_update = {}
+        for event in events:
+            if trace is None:
+                self.log("Creating new trace for chat_id: %s", chat_id)
+                trace_input = self._cap_input(
+                    event["trace_input"], event["trace_input"].get("messages", [])
+                )
+                trace = self.langfuse.start_span(
+                    name=f"chat:{chat_id}",
+                    input=trace_input,
+                    metadata=event["trace_update"]["metadata"],
+                )
+                for evicted_id, evicted_trace in self._lru_set(
+                    self.chat_traces, chat_id, trace
+                ):
+                    # Close the evicted trace so its span is not left open in Langfuse
+                    evicted_trace.end()
+                    self.log("Evicted trace for chat_id: %s", evicted_id)
+            for key, value in event["trace_update"].items():
+                if value is None:
+                    continue
+                if key == "metadata":
+                    trace_update[key] = {**trace_update.get(key, {}), **value}
+                else:
+                    trace_update[key] = value
+
+            if event["kind"] == "input":
+                span_payload = event["span_payload"]
+                if span_payload is not None:
+                    span_payload["input"] = self._cap_input(
+                        span_payload["input"], span_payload["input"]
+                    )
+                    event_span = trace.start_span(**span_payload)
+                    event_span.end()
+                    self.log("User input event logged for chat_id: %s", chat_id)
+                continue
+
+            # Update trace with output and complete metadata
+            trace.update_trace(**trace_update)
+            trace_update = {}
+            # Create LLM generation for the response
+            generation_payload = event["generation_payload"]
+            generation_payload["input"] = self._cap_input(
+                generation_payload["input"], generation_payload["input"]
             )
+            generation = trace.start_generation(**generation_payload)
             # Update with usage if available
-            if usage:
-                generation.update(usage=usage)
+            if event["usage"]:
+                generation.update(usage=event["usage"])
             generation.end()
-            self.log(f"LLM generation completed for chat_id: {chat_id}")
+            self.log("LLM generation completed for chat_id: %s", chat_id)
 
             # === CRITICAL FIX: End the trace immediately after LLM response ===
             trace.end()
-            self.log(f"Trace ended for chat_id: {chat_id}")
-
-        except Exception as e:
-            self.log(f"Failed to create LLM generation: {e}")
-        # Flush data to Langfuse
-        try:
-            if self.langfuse:
-                self.langfuse.flush()
-                self.log("Langfuse data flushed")
-        except Exception as e:
-            self.log(f"Failed to flush Langfuse data: {e}")
-        return body
+            self.log("Trace ended for chat_id: %s", chat_id)
+        if trace_update:
+            trace.update_trace(**trace_update)